@@ -1,51 +1,140 @@
+import argparse
+import asyncio
+import functools
+import json
 import os
+import re
+import shutil
 import subprocess
 import textwrap
 import time
+import urllib.request
+from pathlib import Path
+
+from solana.rpc.async_api import AsyncClient
+from solana.rpc.commitment import Confirmed
+from solana.rpc.types import TxOpts
+from solders.instruction import Instruction
+from solders.keypair import Keypair
+from solders.pubkey import Pubkey
+from solders.system_program import CreateAccountParams, create_account
+from solders.transaction import Transaction
+from spl.token.constants import MINT_LEN
+from spl.token.instructions import (
+    InitializeMintParams,
+    create_associated_token_account,
+    get_associated_token_address,
+    initialize_mint,
+)
 
 TOKEN_2022 = "TokenzQdBNbLqP5VEhdkAS6EPFLC1PHnBqCXEpPxuEb"
 TOKEN = "TokenkegQfeZyiNwAJbNbGKPFXCWuBvf9Ss623VQ5DA"
+RPC_URL = "http://127.0.0.1:8899"
 
 current_dir = os.getcwd()
 subfolder_path = "program/tests/fixtures"
-print(f"Current working directory: {current_dir}")
 test_path = os.path.join(current_dir, subfolder_path)
-print(f"Target for account binaries: {test_path}")
 
 accounts: dict[str, str] = {}
 
+# The CLI and blink share one target directory so their common dependencies are
+# only compiled once, the program is built for the sbf target so it gains
+# nothing from sharing and keeps its own to build alongside them
+target_dir = f"{current_dir}/target-shared"
+
+# Created per event loop in `create_accounts`
+client: AsyncClient
+
+# Set by `setup`
+program_id: str
+wallet_address: str
+payer: Keypair
+
+_FSP_WL_BASE = ("fsp-wl", "--payer", f"{current_dir}/payer.json")
+
+
+# posix_spawn avoids copying the interpreter's page tables on every fork, only
+# use subprocess where we need to read the output
+def _spawn(argv: list[str]) -> int:
+    pid = os.posix_spawnp(argv[0], argv, os.environ)
+    return os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+
+
+# Caches compilation across runs if sccache is available
+def cargo_env(target_dir: str | None = None) -> dict[str, str]:
+    env = dict(os.environ)
+    if target_dir is not None:
+        env["CARGO_TARGET_DIR"] = target_dir
+    if shutil.which("sccache"):
+        env.setdefault("RUSTC_WRAPPER", "sccache")
+    return env
+
+
+# Cargo's job server handles oversubscription, so builds may run concurrently
+async def _spawn_async(argv: list[str], env: dict[str, str] | None = None) -> int:
+    process = await asyncio.create_subprocess_exec(
+        *argv, stdout=subprocess.DEVNULL, env=env
+    )
+    return await process.wait()
+
 
-def install_program(name: str) -> None:
-    subprocess.run(
+async def install_program(name: str) -> int:
+    returncode = await _spawn_async(
         [
             "cargo",
             "build",
             "--release",
             "--manifest-path",
             f"{current_dir}/{name}/Cargo.toml",
-        ]
+        ],
+        env=cargo_env(target_dir),
+    )
+    if returncode != 0:
+        return returncode
+    return await _spawn_async(
+        ["cargo", "install", "--path", f"{current_dir}/{name}"],
+        env=cargo_env(target_dir),
     )
-    subprocess.run(["cargo", "install", "--path", f"{current_dir}/{name}"])
 
 
-# For auto-enter
+# Written in the same format and with the same owner-only permissions as
+# `solana-keygen new`
 def create_keypair(keypair: str) -> None:
     print(f"Generating {keypair} keypair...")
-    subprocess.Popen(
-        [
-            "solana-keygen",
-            "new",
-            "--force",
-            "--no-bip39-passphrase",
-            "--outfile",
-            f"{current_dir}/{keypair}.json",
-        ],
-        stdout=subprocess.DEVNULL,
+    fd = os.open(
+        f"{current_dir}/{keypair}.json", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
     )
+    # The mode only applies to new files, tighten any existing keypair as well
+    os.fchmod(fd, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(list(bytes(Keypair()))))
     print(f"{keypair} keypair generated")
 
 
-def start_validator() -> None:
+# Returns whether the RPC reported healthy before the timeout, gives up early if
+# the validator process has exited
+def wait_for_validator(
+    validator_process: subprocess.Popen, timeout: float = 30
+) -> bool:
+    request = urllib.request.Request(
+        RPC_URL,
+        data=json.dumps({"jsonrpc": "2.0", "id": 1, "method": "getHealth"}).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and validator_process.poll() is None:
+        try:
+            with urllib.request.urlopen(request, timeout=1) as response:
+                if json.load(response).get("result") == "ok":
+                    return True
+        except OSError:
+            pass
+        time.sleep(0.05)
+    return False
+
+
+# The program is loaded at genesis so it does not need to be deployed separately
+def start_validator() -> subprocess.Popen:
     print("Starting validator in the background...")
     validator_process = subprocess.Popen(
         [
@@ -53,86 +142,118 @@ def start_validator() -> None:
             "--reset",
             "--mint",
             wallet_address,
+            "--bpf-program",
+            f"{current_dir}/test-pid.json",
+            f"{current_dir}/program/target/deploy/fsp_wl.so",
+            "--slots-per-epoch",
+            "32",
         ],
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL,
         text=True,
     )
 
-    time.sleep(2)
-    if validator_process.poll() is None:
+    if wait_for_validator(validator_process):
         print("Solana test validator is running in the background")
     else:
+        stop_validator(validator_process)
         stdout, stderr = validator_process.communicate()
         print("Failed to start Solana test validator")
         print(f"STDOUT: {stdout}")
         print(f"STDERR: {stderr}")
         exit(1)
     print("Validator running")
+    return validator_process
 
 
-def get_address(keypair: str) -> str:
-    return subprocess.run(
-        ["solana", "address", "-k", f"{current_dir}/{keypair}.json"],
-        capture_output=True,
-        text=True,
-    ).stdout.strip()
+def stop_validator(validator_process: subprocess.Popen) -> None:
+    validator_process.terminate()
+    try:
+        validator_process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        validator_process.kill()
+        validator_process.wait()
 
 
-def create_mint(keypair: str, token_program: int | None) -> str:
-    command = [
-        "spl-token",
-        "create-token",
-        "--program-id",
-        "",
-        "--fee-payer",
-        f"{current_dir}/payer.json",
-        "--mint-authority",
-        f"{current_dir}/payer.json",
-    ]
+def load_keypair(keypair: str) -> Keypair:
+    with open(f"{current_dir}/{keypair}.json") as f:
+        return Keypair.from_json(f.read())
+
+
+# The public key is stored in the keypair file, no need to ask `solana address`
+def get_address(keypair: str) -> str:
+    return str(load_keypair(keypair).pubkey())
 
+
+def get_token_program(token_program: int | None) -> Pubkey:
     if token_program == 2022:
-        command[3] = TOKEN_2022
-    else:
-        command[3] = TOKEN
-
-    mint = (
-        subprocess.run(command, capture_output=True, text=True)
-        .stdout.strip()
-        .split("\n")[0]
-        .split()[2]
-        .strip()
+        return Pubkey.from_string(TOKEN_2022)
+    return Pubkey.from_string(TOKEN)
+
+
+async def send_transaction(
+    instructions: list[Instruction], signers: list[Keypair]
+) -> None:
+    blockhash = (await client.get_latest_blockhash()).value.blockhash
+    transaction = Transaction.new_signed_with_payer(
+        instructions, payer.pubkey(), signers, blockhash
+    )
+    await client.send_transaction(
+        transaction,
+        opts=TxOpts(skip_confirmation=False, preflight_commitment=Confirmed),
     )
-    print(f"{keypair} address: {mint}")
-    return mint
 
 
-def create_token_account(
+async def create_mint(keypair: str, token_program: int | None) -> str:
+    mint = load_keypair(keypair)
+    token_program_id = get_token_program(token_program)
+    lamports = (await client.get_minimum_balance_for_rent_exemption(MINT_LEN)).value
+
+    await send_transaction(
+        [
+            create_account(
+                CreateAccountParams(
+                    from_pubkey=payer.pubkey(),
+                    to_pubkey=mint.pubkey(),
+                    lamports=lamports,
+                    space=MINT_LEN,
+                    owner=token_program_id,
+                )
+            ),
+            initialize_mint(
+                InitializeMintParams(
+                    decimals=9,
+                    program_id=token_program_id,
+                    mint=mint.pubkey(),
+                    mint_authority=payer.pubkey(),
+                    freeze_authority=None,
+                )
+            ),
+        ],
+        [payer, mint],
+    )
+
+    print(f"{keypair} address: {mint.pubkey()}")
+    return str(mint.pubkey())
+
+
+async def create_token_account(
     mint_address: str, owner_address: str, token_program: int | None
 ) -> str:
-    command = [
-        "spl-token",
-        "create-account",
-        "--program-id",
-        "",
-        "--fee-payer",
-        f"{current_dir}/payer.json",
-        "--owner",
-        owner_address,
-        mint_address,
-    ]
+    mint = Pubkey.from_string(mint_address)
+    owner = Pubkey.from_string(owner_address)
+    token_program_id = get_token_program(token_program)
 
-    if token_program == 2022:
-        command[3] = TOKEN_2022
-    else:
-        command[3] = TOKEN
-
-    token_account = (
-        subprocess.run(command, capture_output=True, text=True)
-        .stdout.strip()
-        .split("\n")[0]
-        .split()[2]
-        .strip()
+    await send_transaction(
+        [
+            create_associated_token_account(
+                payer.pubkey(), owner, mint, token_program_id=token_program_id
+            )
+        ],
+        [payer],
+    )
+    token_account = str(
+        get_associated_token_address(owner, mint, token_program_id=token_program_id)
     )
 
     output_string = textwrap.dedent(
@@ -148,19 +269,25 @@ def create_token_account(
     return token_account
 
 
+# fsp-wl has no json output, so look up values by their label rather than by
+# position in case other lines are printed first. Labels are printed before the
+# transaction is sent, so callers must check the exit status as well
+def parse_field(output: str, field: str) -> str:
+    for line in output.splitlines():
+        if line.startswith(f"{field}:"):
+            return line.split(":", 1)[1].strip()
+    raise ValueError(f"{field} not found in output: {output}")
+
+
 def create_ticket(mint_address: str) -> str:
     command = [
-        "fsp-wl",
-        "--payer",
-        f"{current_dir}/payer.json",
+        *_FSP_WL_BASE,
         "register",
         mint_address,
     ]
-    ticket_address = (
-        subprocess.run(command, capture_output=True, text=True)
-        .stdout.strip()
-        .split()[1]
-        .strip()
+    ticket_address = parse_field(
+        subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout,
+        "Ticket",
     )
 
     output_string = textwrap.dedent(
@@ -177,9 +304,7 @@ def create_ticket(mint_address: str) -> str:
 
 def create_whitelist(mint_address: str, wallet_address: str) -> str:
     command = [
-        "fsp-wl",
-        "--payer",
-        f"{current_dir}/payer.json",
+        *_FSP_WL_BASE,
         "init",
         mint_address,
         wallet_address,
@@ -187,12 +312,9 @@ def create_whitelist(mint_address: str, wallet_address: str) -> str:
         "10",
         "5",
     ]
-    whitelist = (
-        subprocess.run(command, capture_output=True, text=True)
-        .stdout.strip()
-        .split("\n")[0]
-        .split()[2]
-        .strip()
+    whitelist = parse_field(
+        subprocess.run(command, stdout=subprocess.PIPE, text=True, check=True).stdout,
+        "Whitelist Account",
     )
 
     output_string = textwrap.dedent(
@@ -209,138 +331,226 @@ def create_whitelist(mint_address: str, wallet_address: str) -> str:
 
 def allow_registration(mint_address: str) -> None:
     command = [
-        "fsp-wl",
-        "--payer",
-        f"{current_dir}/payer.json",
+        *_FSP_WL_BASE,
         "allow-register",
         mint_address,
         "true",
     ]
-    subprocess.run(command)
+    returncode = _spawn(command)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
 
 
-def generate_account_binary(bin_name: str, account: str) -> None:
-    command = [
-        "solana",
-        "account",
-        account,
-        "--output-file",
-        f"{test_path}/{bin_name}.bin",
-    ]
-    subprocess.run(command)
-
-
-# Generate program id keypair
-create_keypair("test-pid")
-program_id = get_address("test-pid")
-
-# Replace the program id in entrypoint.rs
-print("Replacing program id before compilation")
-search_string = "'declare_id!'"
-sed_command = f"sed -i '/{search_string}/c\\declare_id!(\"{program_id}\");' {current_dir}/program/src/lib.rs"
-os.system(sed_command)
-
-# Generate payer keypair
-create_keypair("payer")
-wallet_address = get_address("payer")
-
-# Generate mint keypairs
-create_keypair("mint_2022")
-create_keypair("mint")
+# Fetches every account in one request and writes the raw account data, the
+# same format `solana account --output-file` produces
+async def generate_account_binaries() -> None:
+    response = await client.get_multiple_accounts(
+        [Pubkey.from_string(account) for account in accounts.values()]
+    )
+    binaries: dict[str, bytes] = {}
+    missing: list[str] = []
+    for bin_name, account in zip(accounts, response.value, strict=True):
+        if account is None:
+            missing.append(bin_name)
+        else:
+            binaries[bin_name] = account.data
+
+    # Fail before writing anything so `cargo test` never runs against a mix of
+    # new and stale fixtures
+    if missing:
+        raise RuntimeError(f"Accounts not found for: {', '.join(missing)}")
+
+    os.makedirs(test_path, exist_ok=True)
+    for bin_name, data in binaries.items():
+        with open(f"{test_path}/{bin_name}.bin", "wb") as f:
+            f.write(data)
+
+
+# Each token program's accounts only depend on each other, so both branches run
+# concurrently and the CLI calls are handed off to worker threads
+async def create_branch(token_program: int | None) -> None:
+    suffix = "_2022" if token_program == 2022 else ""
+
+    # Create spl-token
+    mint = accounts[f"mint{suffix}"] = await create_mint(
+        f"mint{suffix}", token_program
+    )
 
-# Generate whitelist keypair
-create_keypair("whitelist")
+    # Create token account and whitelist address
+    accounts[f"wallet_token_account{suffix}"], whitelist = await asyncio.gather(
+        create_token_account(mint, wallet_address, token_program),
+        asyncio.to_thread(create_whitelist, mint, wallet_address),
+    )
+    accounts[f"whitelist{suffix}"] = whitelist
+
+    # The vault is created by `fsp-wl init` as the whitelist's associated token
+    # account
+    accounts[f"vault{suffix}"] = str(
+        get_associated_token_address(
+            Pubkey.from_string(whitelist),
+            Pubkey.from_string(mint),
+            token_program_id=get_token_program(token_program),
+        )
+    )
 
-# Start a test validator to retrieve account binaries
-start_validator()
+    # Enable registration
+    await asyncio.to_thread(allow_registration, mint)
 
-# Compile and deploy the whitelist program
-subprocess.run(
-    ["cargo", "build-bpf", "--manifest-path", f"{current_dir}/program/Cargo.toml"]
-)
-subprocess.run(
-    [
-        "solana",
-        "program",
-        "deploy",
-        f"{current_dir}/program/target/deploy/fsp_wl.so",
-        "--program-id",
-        f"{current_dir}/test-pid.json",
-        "--fee-payer",
-        f"{current_dir}/payer.json",
-    ]
-)
+    # Create ticket address
+    ticket = accounts[f"ticket_account{suffix}"] = await asyncio.to_thread(
+        create_ticket, mint
+    )
 
-subprocess.run(
-    ["cargo", "build", "--release", "--manifest-path", f"{current_dir}/cli/Cargo.toml"]
-)
+    # Create ticket token account
+    accounts[f"ticket_token_account{suffix}"] = await create_token_account(
+        mint, ticket, token_program
+    )
 
-# Compile and install the blink, cause why not?
-install_program("blink")
 
-# Create spl-token (2022)
-accounts["mint_2022"] = create_mint("mint_2022", 2022)
-accounts["mint"] = create_mint("mint", None)
+# Fresh mint keypairs are generated on every call, so fixtures can be populated
+# again against the same validator
+async def create_accounts() -> None:
+    global client
+    client = AsyncClient(RPC_URL, commitment=Confirmed)
+
+    try:
+        create_keypair("mint_2022")
+        create_keypair("mint")
+
+        await asyncio.gather(create_branch(2022), create_branch(None))
+
+        # Get account binaries
+        await generate_account_binaries()
+    finally:
+        await client.close()
+
+
+async def build_programs() -> tuple[int, int, int]:
+    return await asyncio.gather(
+        # Compile the whitelist program
+        _spawn_async(
+            [
+                "cargo",
+                "build-bpf",
+                "--manifest-path",
+                f"{current_dir}/program/Cargo.toml",
+            ],
+            env=cargo_env(),
+        ),
+        _spawn_async(
+            [
+                "cargo",
+                "build",
+                "--release",
+                "--manifest-path",
+                f"{current_dir}/cli/Cargo.toml",
+            ],
+            env=cargo_env(target_dir),
+        ),
+        # Compile and install the blink, cause why not?
+        install_program("blink"),
+    )
 
-# Create token account (2022)
-accounts["wallet_token_account_2022"] = create_token_account(
-    accounts["mint_2022"], wallet_address, 2022
-)
-accounts["wallet_token_account"] = create_token_account(
-    accounts["mint"], wallet_address, None
-)
 
-# Create whitelist address for token2022
-accounts["whitelist_2022"] = create_whitelist(accounts["mint_2022"], wallet_address)
-accounts["whitelist"] = create_whitelist(accounts["mint"], wallet_address)
+# Keypairs, builds and the validator are only set up once per process so that
+# any further drivers importing this module reuse them
+@functools.cache
+def setup() -> subprocess.Popen:
+    global program_id, wallet_address, payer
+
+    # Generate program id, payer and whitelist keypairs
+    for keypair in ["test-pid", "payer", "whitelist"]:
+        create_keypair(keypair)
+    program_id = get_address("test-pid")
+
+    # Replace the program id in entrypoint.rs
+    print("Replacing program id before compilation")
+    lib_path = Path(f"{current_dir}/program/src/lib.rs")
+    lib_source, count = re.subn(
+        r'declare_id!\("[^"]*"\);',
+        f'declare_id!("{program_id}");',
+        lib_path.read_text(),
+    )
+    if count != 1:
+        print(f"Expected one declare_id! in {lib_path}, found {count}")
+        exit(1)
+    lib_path.write_text(lib_source)
 
-# Create the vault
-accounts["vault_2022"] = create_token_account(
-    accounts["mint_2022"], accounts["whitelist_2022"], 2022
-)
-accounts["vault"] = create_token_account(accounts["mint"], accounts["whitelist"], None)
+    wallet_address = get_address("payer")
+    payer = load_keypair("payer")
 
-# Enable registration
-allow_registration(accounts["mint_2022"])
-allow_registration(accounts["mint"])
+    if any(asyncio.run(build_programs())):
+        print("Failed to build the program, CLI or blink")
+        exit(1)
 
-# Create ticket address
-accounts["ticket_account_2022"] = create_ticket(accounts["mint_2022"])
-accounts["ticket_account"] = create_ticket(accounts["mint"])
+    # Start a test validator with the program deployed to retrieve account
+    # binaries, it is kept running until all tests have completed
+    return start_validator()
 
-# Create ticket token accounts
-accounts["ticket_token_account_2022"] = create_token_account(
-    accounts["mint_2022"], accounts["ticket_account_2022"], 2022
-)
-accounts["ticket_token_account"] = create_token_account(
-    accounts["mint"], accounts["ticket_account"], None
-)
 
-for account in accounts:
-    generate_account_binary(account, accounts[account])
-# Get account binaries
+def teardown(validator_process: subprocess.Popen) -> None:
+    print("Stopping solana-test-validator")
+    stop_validator(validator_process)
+    setup.cache_clear()
 
-# Clean up keypairs
-print("Cleaning up keypairs...")
-os.remove(f"{current_dir}/mint.json")
-os.remove(f"{current_dir}/mint_2022.json")
-os.remove(f"{current_dir}/whitelist.json")
-os.remove(f"{current_dir}/payer.json")
-print("Keypairs removed")
+    # Clean up keypairs
+    print("Cleaning up keypairs...")
+    # Mint keypairs only exist once `create_accounts` has run
+    for keypair in ["mint", "mint_2022", "whitelist", "payer"]:
+        if os.path.exists(f"{current_dir}/{keypair}.json"):
+            os.remove(f"{current_dir}/{keypair}.json")
+    print("Keypairs removed")
 
-print("Stopping solana-test-validator")
-subprocess.run(["pkill", "-f", "-9", "solana-test-validator"])
 
-print("Starting tests...")
-subprocess.run(
-    ["cargo", "test", "--manifest-path", f"{current_dir}/program/Cargo.toml"]
-)
-print("Cargo tests complete")
-
-validator_tests = input("Would you like to run local validator tests?[Y/n]:")
-if validator_tests == "Y" or "y" or "yes":
-    print("Starting validator tests...")
-    # validator_testing
-else:
-    print("Testing completed")
-    exit(0)
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build the program and populate the test fixtures"
+    )
+    parser.add_argument(
+        "--unattended",
+        action="store_true",
+        help="Never prompt for input, validator tests are skipped unless requested",
+    )
+    parser.add_argument(
+        "--run-validator-tests",
+        action="store_true",
+        help="Run local validator tests without prompting",
+    )
+    args = parser.parse_args()
+
+    print(f"Current working directory: {current_dir}")
+    print(f"Target for account binaries: {test_path}")
+
+    validator_process = setup()
+    try:
+        asyncio.run(create_accounts())
+
+        print("Starting tests...")
+        returncode = _spawn(
+            ["cargo", "test", "--manifest-path", f"{current_dir}/program/Cargo.toml"]
+        )
+        print("Cargo tests complete")
+
+        if args.run_validator_tests:
+            run_validator_tests = True
+        elif args.unattended:
+            run_validator_tests = False
+        else:
+            validator_tests = input(
+                "Would you like to run local validator tests?[Y/n]:"
+            )
+            run_validator_tests = validator_tests.strip().lower() in {"y", "yes", ""}
+
+        if run_validator_tests:
+            print("Starting validator tests...")
+            # validator_testing
+        else:
+            print("Testing completed")
+    finally:
+        teardown(validator_process)
+
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()